@@ -1,27 +1,37 @@
-from __future__ import print_function
-
-import binascii
+import collections
+import concurrent.futures
 import datetime
+import functools
 import gzip
 import hashlib
+import html
+import io
 import os
+import queue
+import re
+import secrets
 import shutil
+import sqlite3
 import sys
-
-import bs4
+import threading
+import time
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape as xml_escape
+from xml.sax.saxutils import quoteattr
+
+import jinja2
+import lxml.etree
+import lxml.html
+import orjson
 import requests
 from dateutil import tz
-from feedgen.feed import FeedGenerator
-from flask import (Flask, abort, jsonify, make_response, redirect,
-                   render_template, request, url_for)
+from flask import (Flask, Response, abort, make_response, redirect,
+                   render_template, request, stream_with_context, url_for)
 from peewee import *  # noqa
-
-try:
-    # Python 3
-    from urllib.parse import urljoin, urlparse, urlunparse
-except ImportError:
-    # Python 2
-    from urlparse import urljoin, urlparse, urlunparse
+from playhouse.pool import PooledSqliteDatabase
+from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 DIGIMARKS_USER_AGENT = 'digimarks/1.2.0-dev'
@@ -149,6 +159,8 @@ themes = {
         'COMMENT': '',
     }
 }
+# Looked up once, as it is used for every page without a user
+default_theme = themes[DEFAULT_THEME]
 
 try:
     import settings
@@ -160,83 +172,244 @@ except ImportError:
 APP_ROOT = os.path.dirname(os.path.realpath(__file__))
 MEDIA_ROOT = os.path.join(APP_ROOT, 'static')
 MEDIA_URL = '/static/'
-DATABASE = {
-    'name': os.path.join(APP_ROOT, 'bookmarks.db'),
-    'engine': 'peewee.SqliteDatabase',
-}
+DATABASE_PATH = os.path.join(APP_ROOT, 'bookmarks.db')
 #PHANTOM = '/usr/local/bin/phantomjs'
 #SCRIPT = os.path.join(APP_ROOT, 'screenshot.js')
 
 # create our flask app and a database wrapper
 app = Flask(__name__)
 app.config.from_object(__name__)
-database = SqliteDatabase(os.path.join(APP_ROOT, 'bookmarks.db'))
+# Connections are handed out per request from a pool, instead of opening the database file every time
+database = PooledSqliteDatabase(
+    DATABASE_PATH,
+    max_connections=16,
+    stale_timeout=300,
+    # Wait this long (in seconds) for a connection when all are in use, instead of failing right away
+    timeout=10,
+    check_same_thread=False,  # pooled connections can be reused by another request thread
+    # Applied to every new connection: WAL lets readers continue while a bookmark is written,
+    # and only syncs on checkpoints
+    pragmas={
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': -20000,  # 20MB
+        'temp_store': 'memory',
+        'mmap_size': 268435456,  # 256MB
+        'foreign_keys': 1,
+    },
+)
 
 # Strip unnecessary whitespace due to jinja2 codeblocks
 app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
 
+# Keep the compiled templates on disk, so (new) workers do not have to parse and compile them again
+JINJA_CACHE_DIR = getattr(settings, 'JINJA_CACHE_DIR', os.path.join(APP_ROOT, '.jinja_cache'))
+try:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    cache_dir_writable = os.access(JINJA_CACHE_DIR, os.W_OK)
+except OSError:
+    cache_dir_writable = False
+if cache_dir_writable:
+    app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(JINJA_CACHE_DIR)
+else:
+    # For example when running as a user that cannot write in the code directory; compile in memory only
+    print('Template cache directory {} is not writable, not caching compiled templates'.format(JINJA_CACHE_DIR))
+# Templates only change with a new release, which restarts the workers; don't check their files on every render,
+# except when debugging
+app.config['TEMPLATES_AUTO_RELOAD'] = getattr(settings, 'DEBUG', False)
+app.jinja_env.auto_reload = app.config['TEMPLATES_AUTO_RELOAD']
+# Load all templates up front, so the first requests do not have to wait for that
+for template_name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template_name)
+
 # set custom url for the app, for example '/bookmarks'
 try:
     app.config['APPLICATION_ROOT'] = settings.APPLICATION_ROOT
 except AttributeError:
     pass
 
-# Cache the tags
-all_tags = {}
-usersettings = {}
-
-
-def ifilterfalse(predicate, iterable):
-    # ifilterfalse(lambda x: x%2, range(10)) --> 0 2 4 6 8
-    if predicate is None:
-        predicate = bool
-    for x in iterable:
-        if not predicate(x):
-            yield x
-
-
-def unique_everseen(iterable, key=None):
-    "List unique elements, preserving order. Remember all elements ever seen."
-    # unique_everseen('AAAABBBCCDAABBB') --> A B C D
-    # unique_everseen('ABBCcAD', str.lower) --> A B C D
-    seen = set()
-    seen_add = seen.add
-    if key is None:
-        for element in ifilterfalse(seen.__contains__, iterable):
-            seen_add(element)
-            yield element
-    else:
-        for element in iterable:
-            k = key(element)
-            if k not in seen:
-                seen_add(k)
-                yield element
+
+class VersionedCache(object):
+    """ Least recently used cache, of values that are valid for one version of the database
+
+    Holds at most `max_entries` values, and if `max_size` is given, values of at most that total `sizeof()`. Shared by
+    the request (and background) threads, so all access is locked.
+    """
+
+    def __init__(self, max_entries, max_size=None, sizeof=len):
+        self.entries = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        """ Value cached for `key` at `version`, or None if there is none (anymore) """
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is None or cached[0] != version:
+                return None
+            self.entries.move_to_end(key)
+            return cached[1]
+
+    def put(self, key, version, value):
+        """ Cache `value` for `key` at `version`, forgetting the least recently used values when full """
+        size = self.sizeof(value) if self.max_size else 0
+        with self.lock:
+            replaced = self.entries.pop(key, None)
+            if replaced is not None:
+                self.size -= replaced[2]
+            self.entries[key] = (version, value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or (self.max_size and self.size > self.max_size):
+                self.size -= self.entries.popitem(last=False)[1][2]
+
+
+# Cache the tag counts of the most recently active users, loaded on first use
+all_tags = VersionedCache(1024)
+# Theme (the dict from `themes`) per user, looked up once at startup
+userthemes = {}
+
+# Rendered bookmarks.js of the most recently active users; it lists all their bookmarks, so limit the total size too
+bookmarks_js_cache = VersionedCache(256, max_size=8 * 1024 * 1024)
+# Rendered pages of the most recently visited urls, per (userkey, path with query string); a page of 100 cards is
+# about 250 KB, so the total size of the pages is limited too (in characters)
+page_cache = VersionedCache(256, max_size=16 * 1024 * 1024)
+# Rendered 404 page, filled on first use
+not_found_page = None
+# Rendered homepage and its ETag, filled on first use
+index_page = None
+index_etag = None
+
+# Whether init_db() has been run in this process
+db_initialised = False
+init_lock = threading.Lock()
+
+# Shared HTTP session, so connections to the same host (like the favicon service) are kept alive and reused
+http_session = requests.Session()
+http_session.headers['User-Agent'] = DIGIMARKS_USER_AGENT
+http_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1),
+)
+http_session.mount('http://', http_adapter)
+http_session.mount('https://', http_adapter)
+# (connect, read) timeout in seconds, so an unresponsive site does not keep a request
+# and a pooled connection waiting forever
+HTTP_TIMEOUT = (5, 15)
+
+# json responses from this size (in bytes) on are gzipped
+JSON_GZIP_MIN_SIZE = 1024
+
+# Number of bookmarks shown per page in the bookmark overviews
+BOOKMARKS_PER_PAGE = 100
+# Highest page number accepted
+MAX_PAGE = 10 ** 9
+
+# Number of favicons to fetch at the same time when (re)fetching them in bulk
+FAVICON_WORKERS = 32
+# Threads for work that does not need to hold up a response, like fetching the favicon of a new bookmark
+background_tasks = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+# Favicons found in the background are stored by this single thread, so those threads don't compete for writing
+favicon_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+# (bookmark id, favicon) waiting to be stored by the favicon writer
+pending_favicons = queue.Queue()
+# Downloaded favicons are reused for other bookmarks on the same domain for this long (in seconds)
+FAVICON_MAX_AGE = 30 * 24 * 60 * 60
+FAVICON_EXTENSIONS = ('.png', '.ico', '.jpg')
+FAVICON_EXTENSION_BY_TYPE = {
+    'image/jpeg': '.jpg',
+    'image/x-icon': '.ico',
+    'image/vnd.microsoft.icon': '.ico',
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_url(url):
+    """ urlparse, cached; listings and favicon refreshes parse the same urls over and over """
+    return urlparse(url)
+
 
 def clean_tags(tags_list):
-    tags_res = [x.strip() for x in tags_list]
-    tags_res = list(unique_everseen(tags_res))
-    tags_res.sort()
-    if tags_res and tags_res[0] == '':
-        del tags_res[0]
-    return tags_res
-
-
-magic_dict = {
-    b"\x1f\x8b\x08": "gz",
-    b"\x42\x5a\x68": "bz2",
-    b"\x50\x4b\x03\x04": "zip"
-    }
+    """ Strip the tags, drop empty and duplicate ones, and sort them """
+    return sorted({tag.strip() for tag in tags_list} - {''})
 
-max_len = max(len(x) for x in magic_dict)
 
-def file_type(filename):
-    with open(filename, "rb") as f:
-        file_start = f.read(max_len)
-    for magic, filetype in magic_dict.items():
-        if file_start.startswith(magic):
-            return filetype
-    return "no match"
+GZIP_MAGIC = b"\x1f\x8b\x08"
+
+# The page title is looked for in this first part of the page, with a regex instead of parsing the whole HTML
+TITLE_RE = re.compile(rb'<title[^>]*>([^<]{1,512})</title>', re.IGNORECASE)
+TITLE_SCAN_SIZE = 65536
+# The title belongs in the head, so there is no need to read on after it
+HEAD_END_RE = re.compile(rb'</head\s*>', re.IGNORECASE)
+# <meta charset="..."> or <meta http-equiv="Content-Type" content="text/html; charset=...">
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w.:-]+)', re.IGNORECASE)
+
+
+def save_favicon(response, filename):
+    """ Write the favicon from the streamed `response` to `filename`, decompressing gzipped content on the way
+
+    When reading fails halfway, the incomplete file is removed again, so it is not taken for a recent favicon later.
+    """
+    try:
+        # urllib3 undoes the Content-Encoding while reading; some services send a gzipped file without it though
+        response.raw.decode_content = True
+        source = io.BufferedReader(response.raw, 64 * 1024)
+        if source.peek(len(GZIP_MAGIC)).startswith(GZIP_MAGIC):
+            source = gzip.GzipFile(fileobj=source)
+        with open(filename, 'wb') as out_file:
+            shutil.copyfileobj(source, out_file, 64 * 1024)
+    except Exception:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    finally:
+        # Return the connection to the pool, also after an error
+        response.close()
+
+
+# Current local time, filled in by the database itself when writing; local like the datetime.now() defaults
+DB_NOW = fn.datetime('now', 'localtime')
+
+
+def page_encoding(response, content):
+    """ Character encoding of the HTML page in `response`, of which `content` is the start
+
+    Taken from the charset in the Content-Type header, then from a <meta> tag, defaulting to UTF-8; requests itself
+    falls back to ISO-8859-1 for any text/html response without a charset.
+    """
+    if 'charset=' in response.headers.get('content-type', '').lower():
+        return response.encoding
+    match = META_CHARSET_RE.search(content)
+    if match:
+        return match.group(1).decode('ascii')
+    return 'utf-8'
+
+
+def get_page_title(response):
+    """ Title of the HTML page in streamed `response`; only the start of the page is downloaded to look for it """
+    content = b''
+    for chunk in response.iter_content(8192):
+        content += chunk
+        match = TITLE_RE.search(content)
+        if match:
+            try:
+                title = match.group(1).decode(page_encoding(response, content), 'replace')
+            except LookupError:
+                # Unknown encoding name
+                title = match.group(1).decode('utf-8', 'replace')
+            return html.unescape(title).strip()
+        if len(content) >= TITLE_SCAN_SIZE or HEAD_END_RE.search(content):
+            break
+    # No simple <title> found, parse what was read instead
+    try:
+        title = lxml.html.fromstring(content).findtext('.//title')
+    except (lxml.etree.ParserError, ValueError):
+        return ''
+    return (title or '').strip()
 
 
 class BaseModel(Model):
@@ -253,7 +426,7 @@ class User(BaseModel):
 
     def generate_key(self):
         """ Generate userkey """
-        self.key = binascii.hexlify(os.urandom(24))
+        self.key = secrets.token_hex(24)
         return self.key
 
 
@@ -295,79 +468,73 @@ class Bookmark(BaseModel):
 
     class Meta:
         ordering = (('created_date', 'desc'),)
+        indexes = (
+            # Single bookmark lookups, like redirecting and editing; not unique, as older databases can have duplicates
+            (('userkey', 'url_hash'), False),
+            # Listing the (visible, starred, ...) bookmarks of a user, newest first, without a separate sort
+            (('userkey', 'status', 'created_date'), False),
+        )
 
     def set_hash(self):
-        """ Generate hash """
-        self.url_hash = hashlib.md5(self.url.encode('utf-8')).hexdigest()
+        """ Generate hash; BLAKE2b is faster than md5, and with a 16 byte digest has the same length """
+        self.url_hash = hashlib.blake2b(self.url.encode('utf-8'), digest_size=16).hexdigest()
 
     def set_title_from_source(self):
         """ Request the title by requesting the source url """
         try:
-            result = requests.get(self.url, headers={'User-Agent': DIGIMARKS_USER_AGENT})
-            self.http_status = result.status_code
+            result = http_session.get(self.url, stream=True, timeout=HTTP_TIMEOUT)
         except:
             # For example 'MissingSchema: Invalid URL 'abc': No schema supplied. Perhaps you meant http://abc?'
             self.http_status = 404
-        if self.http_status == 200 or self.http_status == 202:
-            html = bs4.BeautifulSoup(result.text, 'html.parser')
-            try:
-                self.title = html.title.text.strip()
-            except AttributeError:
-                self.title = ''
+            return self.title
+        with result:
+            self.http_status = result.status_code
+            if self.http_status == 200 or self.http_status == 202:
+                try:
+                    self.title = get_page_title(result)
+                except requests.RequestException as e:
+                    print(e)
         return self.title
 
     def set_status_code(self):
         """ Check the HTTP status of the url, as it might not exist for example """
         try:
-            result = requests.head(self.url, headers={'User-Agent': DIGIMARKS_USER_AGENT})
+            result = http_session.head(self.url, timeout=HTTP_TIMEOUT)
             self.http_status = result.status_code
-        except requests.ConnectionError:
+        except (requests.ConnectionError, requests.Timeout):
             self.http_status = self.HTTP_CONNECTIONERROR
         return self.http_status
 
     def _set_favicon_with_iconsbetterideaorg(self, domain):
         """ Fetch favicon for the domain """
-        fileextension = '.png'
-        meta = requests.head(
-            'http://icons.better-idea.org/icon?size=60&url=' + domain,
-            allow_redirects=True,
-            headers={'User-Agent': DIGIMARKS_USER_AGENT}
-        )
-        if meta.url[-3:].lower() == 'ico':
-            fileextension = '.ico'
-        response = requests.get(
+        # The redirect target of the streamed GET tells the extension, no separate HEAD needed to find out first
+        response = http_session.get(
             'http://icons.better-idea.org/icon?size=60&url=' + domain,
             stream=True,
-            headers={'User-Agent': DIGIMARKS_USER_AGENT}
+            timeout=HTTP_TIMEOUT
         )
-        filename = os.path.join(MEDIA_ROOT, 'favicons/' + domain + fileextension)
-        with open(filename, 'wb') as out_file:
-            shutil.copyfileobj(response.raw, out_file)
-        del response
-        filetype = file_type(filename)
-        if filetype == 'gz':
-            # decompress
-            orig = gzip.GzipFile(filename, 'rb')
-            origcontent = orig.read()
-            orig.close()
-            os.remove(filename)
-            with open(filename, 'wb') as new:
-                new.write(origcontent)
+        fileextension = '.png'
+        if response.url[-3:].lower() == 'ico' or response.headers.get('content-type') == 'image/x-icon':
+            fileextension = '.ico'
+        save_favicon(response, os.path.join(MEDIA_ROOT, 'favicons/' + domain + fileextension))
         self.favicon = domain + fileextension
 
     def _set_favicon_with_realfavicongenerator(self, domain):
         """ Fetch favicon for the domain """
-        response = requests.get(
+        response = http_session.get(
             'https://realfavicongenerator.p.rapidapi.com/favicon/icon?platform=android_chrome&site=' + domain,
             stream=True,
-            headers={'User-Agent': DIGIMARKS_USER_AGENT, 'X-Mashape-Key': settings.MASHAPE_API_KEY}
+            headers={'X-Mashape-Key': settings.MASHAPE_API_KEY},
+            timeout=HTTP_TIMEOUT
         )
         if response.status_code == 404:
-            # Fall back to desktop favicon
-            response = requests.get(
+            # Fall back to desktop favicon; release the streamed connection of the first try
+            response.close()
+            response = http_session.get(
                 'https://realfavicongenerator.p.rapidapi.com/favicon/icon?platform=desktop&site=' + domain,
                 stream=True,
-                headers={'User-Agent': DIGIMARKS_USER_AGENT, 'X-Mashape-Key': settings.MASHAPE_API_KEY}
+                headers={'X-Mashape-Key': settings.MASHAPE_API_KEY},
+                timeout=HTTP_TIMEOUT
             )
         # Debug for the moment
         print(domain)
@@ -375,40 +542,27 @@ class Bookmark(BaseModel):
         if 'Content-Length' in response.headers and response.headers['Content-Length'] == '0':
             # No favicon found, likely
             print('Skipping this favicon, needs fallback')
+            response.close()
             return
         # Default to 'image/png'
-        fileextension = '.png'
-        if response.headers['content-type'] == 'image/jpeg':
-            fileextension = '.jpg'
-        if response.headers['content-type'] == 'image/x-icon':
-            fileextension = '.ico'
-        filename = os.path.join(MEDIA_ROOT, 'favicons/' + domain + fileextension)
-        with open(filename, 'wb') as out_file:
-            shutil.copyfileobj(response.raw, out_file)
-        del response
-        filetype = file_type(filename)
-        if filetype == 'gz':
-            # decompress
-            orig = gzip.GzipFile(filename, 'rb')
-            origcontent = orig.read()
-            orig.close()
-            os.remove(filename)
-            with open(filename, 'wb') as new:
-                new.write(origcontent)
+        content_type = response.headers.get('content-type', '').split(';')[0].strip()
+        fileextension = FAVICON_EXTENSION_BY_TYPE.get(content_type, '.png')
+        save_favicon(response, os.path.join(MEDIA_ROOT, 'favicons/' + domain + fileextension))
         self.favicon = domain + fileextension
 
     def set_favicon(self):
         """ Fetch favicon for the domain """
-        u = urlparse(self.url)
+        u = parse_url(self.url)
         domain = u.netloc
-        if os.path.isfile(os.path.join(MEDIA_ROOT, 'favicons/' + domain + '.png')):
-            # If file exists, don't re-download it
-            self.favicon = domain + '.png'
-            return
-        if os.path.isfile(os.path.join(MEDIA_ROOT, 'favicons/' + domain + '.ico')):
-            # If file exists, don't re-download it
-            self.favicon = domain + '.ico'
-            return
+        for fileextension in FAVICON_EXTENSIONS:
+            # Favicons are stored per domain; if another bookmark already got a recent one, don't re-download it
+            try:
+                stat = os.stat(os.path.join(MEDIA_ROOT, 'favicons/' + domain + fileextension))
+            except OSError:
+                continue
+            if stat.st_size and time.time() - stat.st_mtime < FAVICON_MAX_AGE:
+                self.favicon = domain + fileextension
+                return
         #self._set_favicon_with_iconsbetterideaorg(domain)
         self._set_favicon_with_realfavicongenerator(domain)
 
@@ -418,24 +572,37 @@ class Bookmark(BaseModel):
         tags_clean = clean_tags(tags_split)
         self.tags = ','.join(tags_clean)
 
+    def save_tags(self, replace=True):
+        """ Store the tags of this (saved) bookmark in the BookmarkTag table, replacing the ones there
+
+        A bookmark that was just inserted has no tags stored yet, so with `replace` False they are only inserted.
+        """
+        if replace:
+            BookmarkTag.delete().where(BookmarkTag.bookmark == self.id).execute()
+        if self.tags_list:
+            BookmarkTag.insert_many(
+                [{'bookmark': self.id, 'userkey': self.userkey, 'tag': tag} for tag in self.tags_list]
+            ).on_conflict_ignore().execute()
+
     def get_redirect_uri(self):
         if self.redirect_uri:
             return self.redirect_uri
         if self.http_status == 301 or self.http_status == 302:
-            result = requests.head(self.url, allow_redirects=True, headers={'User-Agent': DIGIMARKS_USER_AGENT})
+            result = http_session.head(self.url, allow_redirects=True, timeout=HTTP_TIMEOUT)
             self.http_status = result.status_code
             self.redirect_uri = result.url
             return result.url
         return None
 
     def get_uri_domain(self):
-        parsed = urlparse(self.url)
+        parsed = parse_url(self.url)
         return parsed.hostname
 
     @classmethod
     def strip_url_params(cls, url):
-        parsed = urlparse(url)
-        return urlunparse((parsed.scheme, parsed.netloc, parsed.path, parsed.params, '', parsed.fragment))
+        """ Remove the query string from `url`, keeping the fragment; plain string splitting, no (un)parsing needed """
+        url, hash_sign, fragment = url.partition('#')
+        return url.partition('?')[0] + hash_sign + fragment
 
     @property
     def tags_list(self):
@@ -448,7 +615,7 @@ class Bookmark(BaseModel):
         result = {
             'title': self.title,
             'url': self.url,
-            'created':  self.created_date.strftime('%Y-%m-%d %H:%M:%S'),
+            'created':  api_date(self.created_date),
             'url_hash': self.url_hash,
             'tags': self.tags,
         }
@@ -459,6 +626,32 @@ class Bookmark(BaseModel):
         return self.to_dict()
 
 
+class BookmarkTag(BaseModel):
+    """ Tag of a Bookmark; `Bookmark.tags` normalised into rows, so bookmarks can be looked up by tag with an index """
+    bookmark = ForeignKeyField(Bookmark)
+    userkey = CharField()
+    tag = CharField()
+
+    class Meta:
+        primary_key = CompositeKey('bookmark', 'tag')
+        indexes = (
+            (('userkey', 'tag'), False),
+        )
+
+
+# Split the comma separated tags of all bookmarks into bookmarktag rows, in SQLite itself with a recursive CTE
+FILL_BOOKMARKTAGS = """
+INSERT OR IGNORE INTO bookmarktag (bookmark_id, userkey, tag)
+WITH RECURSIVE split(bookmark_id, userkey, tag, rest) AS (
+    SELECT id, userkey, '', tags || ',' FROM bookmark WHERE tags != ''
+    UNION ALL
+    SELECT bookmark_id, userkey, substr(rest, 1, instr(rest, ',') - 1), substr(rest, instr(rest, ',') + 1)
+    FROM split WHERE rest != ''
+)
+SELECT bookmark_id, userkey, tag FROM split WHERE tag != ''
+"""
+
+
 class PublicTag(BaseModel):
     """ Publicly shared tag """
     tagkey = CharField()
@@ -466,67 +659,323 @@ class PublicTag(BaseModel):
     tag = CharField()
     created_date = DateTimeField(default=datetime.datetime.now)
 
+    class Meta:
+        indexes = (
+            # Public pages, json and feeds look the tag up by its key
+            (('tagkey',), True),
+            # Tags page and (un)publishing a tag; not unique, in case an older database has a tag published twice
+            (('userkey', 'tag'), False),
+        )
+
     def generate_key(self):
         """ Generate hash-based key for publicly shared tag """
-        self.tagkey = binascii.hexlify(os.urandom(16))
+        self.tagkey = secrets.token_hex(16)
+
+
+class BookmarkIndex(FTS5Model):
+    """ Full-text index on the searchable Bookmark fields, kept up-to-date by triggers on the bookmark table """
+    rowid = RowIDField()
+    title = SearchField()
+    url = SearchField()
+    note = SearchField()
+
+    class Meta:
+        database = database
+        options = {'content': 'bookmark', 'content_rowid': 'id'}
+
+
+BOOKMARKINDEX_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS bookmark_ai AFTER INSERT ON bookmark BEGIN
+        INSERT INTO bookmarkindex(rowid, title, url, note) VALUES (new.id, new.title, new.url, new.note);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS bookmark_ad AFTER DELETE ON bookmark BEGIN
+        INSERT INTO bookmarkindex(bookmarkindex, rowid, title, url, note)
+        VALUES ('delete', old.id, old.title, old.url, old.note);
+    END""",
+    # Only for changes to the indexed columns, not for favicon, status and such updates
+    """CREATE TRIGGER IF NOT EXISTS bookmark_au AFTER UPDATE OF title, url, note ON bookmark BEGIN
+        INSERT INTO bookmarkindex(bookmarkindex, rowid, title, url, note)
+        VALUES ('delete', old.id, old.title, old.url, old.note);
+        INSERT INTO bookmarkindex(rowid, title, url, note) VALUES (new.id, new.title, new.url, new.note);
+    END""",
+)
+
+
+# Connection of this process that is only used for asking SQLite whether the database changed
+version_connection = None
+version_lock = threading.Lock()
+
+
+def database_version():
+    """ Number that changes whenever a change is committed to the database, by any process
+
+    The caches of tag counts and rendered pages use this, so a bookmark saved by another (uwsgi) worker is not missing
+    from them.
+    """
+    global version_connection
+    with version_lock:
+        if version_connection is None:
+            version_connection = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+        return version_connection.execute('PRAGMA data_version').fetchone()[0]
 
 
 def get_tags_for_user(userkey):
-    """ Extract all tags from the bookmarks """
-    bookmarks = Bookmark.select().filter(Bookmark.userkey == userkey, Bookmark.status == Bookmark.VISIBLE)
-    tags = []
-    for bookmark in bookmarks:
-        tags += bookmark.tags_list
-    return clean_tags(tags)
+    """ Count how many of the visible bookmarks of `userkey` have each tag """
+    query = (BookmarkTag
+             .select(BookmarkTag.tag, fn.COUNT(BookmarkTag.bookmark))
+             .join(Bookmark)
+             .where(BookmarkTag.userkey == userkey, Bookmark.status == Bookmark.VISIBLE)
+             .group_by(BookmarkTag.tag)
+             .tuples())
+    return collections.Counter(dict(query))
+
+
+def get_tag_counts(userkey):
+    """ Cached tag counts of `userkey`, loading them from the database if they are not in the cache or outdated
+
+    Bookmarks can be changed by other worker processes, so the counts are not updated here but loaded again after any
+    change to the database; that is one indexed query, only for the users that are looked at.
+    """
+    version = database_version()
+    tagcounts = all_tags.get(userkey, version)
+    if tagcounts is None:
+        tagcounts = get_tags_for_user(userkey)
+        all_tags.put(userkey, version, tagcounts)
+    return tagcounts
 
 
 def get_cached_tags(userkey):
-    """ Fail-safe way to get the cached tags for `userkey` """
-    try:
-        return all_tags[userkey]
-    except KeyError:
-        return []
+    """ Sorted list of the tags used by `userkey` """
+    return sorted(get_tag_counts(userkey))
+
+
+def cached_page(userkey, render):
+    """ Page for the current url of `userkey` from the cache, or rendered with `render()` if the database changed """
+    key = (userkey, request.full_path)
+    version = database_version()
+    page = page_cache.get(key, version)
+    if page is None:
+        page = render()
+        page_cache.put(key, version, page)
+    return page
 
 
 def get_theme(userkey):
+    """ Theme of `userkey`, or the default theme for unknown users """
+    return userthemes.get(userkey, default_theme)
+
+
+def api_date(date):
+    """ `date` as 'YYYY-mm-dd HH:MM:SS', like the API always returned; isoformat does not parse a format string """
+    return date.isoformat(' ', 'seconds')
+
+
+def serialize_query(query):
+    """ Serialise the bookmarks in `query` like Bookmark.to_dict, from plain row dicts instead of model instances """
+    for row in query.dicts().iterator():
+        yield {
+            'title': row['title'],
+            'url': row['url'],
+            'created': api_date(row['created_date']),
+            'url_hash': row['url_hash'],
+            'tags': row['tags'],
+        }
+
+
+def orjson_response(obj):
+    """ Return `obj` as json response; orjson produces bytes directly, so no str round-trip like with jsonify
+
+    Bigger responses are gzipped right away for clients accepting that, in a fast compression level.
+    """
+    data = orjson.dumps(obj)
+    headers = {'Vary': 'Accept-Encoding'}
+    # Check the quality value too, 'gzip;q=0' means gzip is not accepted
+    if len(data) >= JSON_GZIP_MIN_SIZE and request.accept_encodings['gzip'] > 0:
+        data = gzip.compress(data, compresslevel=1)
+        headers['Content-Encoding'] = 'gzip'
+    return app.response_class(data, mimetype='application/json', headers=headers)
+
+
+def _fts_escape(text):
+    """ Quote `text` as an FTS5 string, so characters like '-' and ':' are not taken for query syntax """
+    return '"{}"'.format(text.replace('"', '""'))
+
+
+# Rendered SQL of the frequently used bookmark queries, keyed on the function building them and its number of arguments
+_prepared_sql = {}
+
+
+def prepared_query(build, *args, page=None):
+    """ Run the query that `build(*args)` returns, rendering its SQL only on the first call
+
+    The first time, `build` is called with placeholders instead of `args`, to find out where the arguments end up in
+    the bound parameters of the rendered SQL. After that the cached SQL is run as raw query with the new arguments,
+    which iterates the same as the original query. `build` has to use its arguments as they are, as query values;
+    a ValueError with its name is raised if one of them does not end up in the bound parameters.
+
+    With `page`, only the bookmarks of that page (counting from 1) are selected, plus the first one of the next page so
+    the caller can tell whether there is one; see `bookmarks_page_of`.
+    """
     try:
-        usertheme = usersettings[userkey]['theme']
-        return themes[usertheme]
+        model, sql, params = _prepared_sql[(build, len(args))]
     except KeyError:
-        return themes[DEFAULT_THEME]  # default
+        placeholders = ['\x00arg{}\x00'.format(i) for i in range(len(args))]
+        query = build(*placeholders)
+        sql, bound = query.sql()
+        params = [(placeholders.index(value), None) if value in placeholders else (None, value) for value in bound]
+        if {index for index, _ in params} - {None} != set(range(len(args))):
+            # An argument was changed (or not used), the SQL would run with the placeholder instead
+            raise ValueError(build.__name__)
+        model = query.model
+        _prepared_sql[(build, len(args))] = (model, sql, params)
+    values = [args[index] if index is not None else value for index, value in params]
+    if page:
+        sql += ' LIMIT ? OFFSET ?'
+        values += [BOOKMARKS_PER_PAGE + 1, (page - 1) * BOOKMARKS_PER_PAGE]
+    return model.raw(sql, *values)
+
+
+def get_page():
+    """ Page number from the `page` query string argument, 1 when missing or invalid """
+    # Capped, so a huge page number cannot overflow the SQLite integer used for the OFFSET
+    return min(max(request.args.get('page', 1, type=int), 1), MAX_PAGE)
+
+
+def bookmarks_page_of(bookmarks):
+    """ Split the bookmarks of a paged query into the ones to show and whether there is a next page """
+    bookmarks = list(bookmarks)
+    return bookmarks[:BOOKMARKS_PER_PAGE], len(bookmarks) > BOOKMARKS_PER_PAGE
+
+
+# Columns shown in bookmark listings and their json. Only the start of the note is needed, for its (truncated) tooltip;
+# 106 characters keeps `note|truncate(100)` the same as on the whole note
+LIST_COLUMNS = (
+    Bookmark.id, Bookmark.title, Bookmark.url, Bookmark.url_hash, Bookmark.tags, Bookmark.starred, Bookmark.favicon,
+    Bookmark.http_status, Bookmark.created_date, fn.substr(Bookmark.note, 1, 106).alias('note'),
+)
+
+
+def _visible_bookmarks(userkey):
+    return Bookmark.select(*LIST_COLUMNS).where(
+        Bookmark.userkey == userkey,
+        Bookmark.status == Bookmark.VISIBLE
+    ).order_by(Bookmark.created_date.desc())
+
+
+def _visible_bookmark_titles(userkey):
+    # Only what the autocompletion of the search field shows
+    return Bookmark.select(Bookmark.title, Bookmark.favicon).where(
+        Bookmark.userkey == userkey,
+        Bookmark.status == Bookmark.VISIBLE
+    ).order_by(Bookmark.created_date.desc())
 
 
-def make_external(url):
-    return urljoin(request.url_root, url)
+def _starred_bookmarks(userkey):
+    return Bookmark.select(*LIST_COLUMNS).where(
+        Bookmark.userkey == userkey,
+        Bookmark.starred
+    ).order_by(Bookmark.created_date.desc())
 
 
-def _find_bookmarks(userkey, filter_text):
-    return Bookmark.select().where(
+def _broken_bookmarks(userkey):
+    return Bookmark.select(*LIST_COLUMNS).where(
         Bookmark.userkey == userkey,
-        (
-            Bookmark.title.contains(filter_text) |
-            Bookmark.url.contains(filter_text) |
-            Bookmark.note.contains(filter_text)
-        ),
+        Bookmark.http_status != 200
+    ).order_by(Bookmark.created_date.desc())
+
+
+def _bookmarks_with_note(userkey):
+    return Bookmark.select(*LIST_COLUMNS).where(
+        Bookmark.userkey == userkey,
+        Bookmark.note != ''
+    ).order_by(Bookmark.created_date.desc())
+
+
+def _matching_bookmarks(userkey, match):
+    return Bookmark.select(*LIST_COLUMNS).join(BookmarkIndex, on=(Bookmark.id == BookmarkIndex.rowid)).where(
+        BookmarkIndex.match(match),
+        Bookmark.userkey == userkey,
+        Bookmark.status == Bookmark.VISIBLE
+    ).order_by(Bookmark.created_date.desc())
+
+
+def _find_bookmarks(userkey, filter_text, page=None):
+    """ Full-text search in title, url and note of the bookmarks of `userkey`, matching on word prefixes """
+    query = ' '.join(_fts_escape(term) + '*' for term in filter_text.split()) or '""'
+    # A column filter only applies to the phrase right after it, so all terms are grouped
+    return prepared_query(_matching_bookmarks, userkey, '{title url note}: (' + query + ')', page=page)
+
+
+def _bookmarks_with_tag(userkey, tag):
+    return Bookmark.select(*LIST_COLUMNS).join(BookmarkTag).where(
+        BookmarkTag.userkey == userkey,
+        BookmarkTag.tag == tag,
+        Bookmark.status == Bookmark.VISIBLE
+    ).order_by(Bookmark.created_date.desc())
+
+
+def _public_bookmarks_with_tag(userkey, tag):
+    # Only the columns used by the json and the feed of a public tag
+    return Bookmark.select(
+        Bookmark.title, Bookmark.url, Bookmark.url_hash, Bookmark.tags, Bookmark.created_date, Bookmark.modified_date
+    ).join(BookmarkTag).where(
+        BookmarkTag.userkey == userkey,
+        BookmarkTag.tag == tag,
         Bookmark.status == Bookmark.VISIBLE
     ).order_by(Bookmark.created_date.desc())
 
 
+def _find_bookmarks_with_tag(userkey, tag, page=None):
+    """ Visible bookmarks of `userkey` that are labelled with `tag` """
+    return prepared_query(_bookmarks_with_tag, userkey, tag, page=page)
+
+
+@app.before_request
+def _db_connect():
+    global db_initialised
+    database.connect(reuse_if_open=True)
+    if not db_initialised:
+        # First request of this process, instead of at import time
+        with init_lock:
+            if not db_initialised:
+                init_db()
+                db_initialised = True
+
+
+@app.teardown_request
+def _db_close(exc):
+    # Returns the connection to the pool
+    if not database.is_closed():
+        database.close()
+
+
 @app.errorhandler(404)
 def page_not_found(e):
-    theme = themes[DEFAULT_THEME]
-    return render_template('404.html', error=e, theme=theme), 404
+    global not_found_page
+    if not_found_page is None:
+        # The 404 page is the same for every request, so only render it once
+        not_found_page = render_template('404.html', theme=default_theme)
+    return not_found_page, 404
 
 
 @app.route('/')
 def index():
     """ Homepage, point visitors to project page """
-    theme = themes[DEFAULT_THEME]
-    return render_template('index.html', theme=theme)
-
-
-def get_bookmarks(userkey, filtermethod=None, sortmethod=None):
-    """ User homepage, list their bookmarks, optionally filtered and/or sorted """
+    global index_page, index_etag
+    if index_page is None:
+        # The homepage never changes while running, render it once
+        page = render_template('index.html', theme=default_theme)
+        index_etag = hashlib.blake2b(page.encode('utf-8'), digest_size=8).hexdigest()
+        index_page = page
+    response = make_response(index_page)
+    response.set_etag(index_etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    return response.make_conditional(request)
+
+
+def get_bookmarks(userkey, filtermethod=None, sortmethod=None, page=None):
+    """ User homepage, list their bookmarks, optionally filtered and/or sorted, and only one page of them if `page` """
     #return object_list('bookmarks.html', Bookmark.select())
     #user = User.select(key=userkey)
     #if user:
@@ -540,6 +989,9 @@ def get_bookmarks(userkey, filtermethod=None, sortmethod=None):
     filter_text = ''
     if request.form:
         filter_text = request.form['filter_text']
+    elif 'filter_text' in request.args:
+        # Next/previous page of search results
+        filter_text = request.args['filter_text']
 
     filter_starred = False
     if filtermethod and filtermethod.lower() == 'starred':
@@ -554,21 +1006,15 @@ def get_bookmarks(userkey, filtermethod=None, sortmethod=None):
         filter_note = True
 
     if filter_text:
-        bookmarks = _find_bookmarks(userkey, filter_text)
+        bookmarks = _find_bookmarks(userkey, filter_text, page=page)
     elif filter_starred:
-        bookmarks = Bookmark.select().where(Bookmark.userkey == userkey,
-                                            Bookmark.starred).order_by(Bookmark.created_date.desc())
+        bookmarks = prepared_query(_starred_bookmarks, userkey, page=page)
     elif filter_broken:
-        bookmarks = Bookmark.select().where(Bookmark.userkey == userkey,
-                                            Bookmark.http_status != 200).order_by(Bookmark.created_date.desc())
+        bookmarks = prepared_query(_broken_bookmarks, userkey, page=page)
     elif filter_note:
-        bookmarks = Bookmark.select().where(Bookmark.userkey == userkey,
-                                            Bookmark.note != '').order_by(Bookmark.created_date.desc())
+        bookmarks = prepared_query(_bookmarks_with_note, userkey, page=page)
     else:
-        bookmarks = Bookmark.select().where(
-            Bookmark.userkey == userkey,
-            Bookmark.status == Bookmark.VISIBLE
-        ).order_by(Bookmark.created_date.desc())
+        bookmarks = prepared_query(_visible_bookmarks, userkey, page=page)
 
     return bookmarks, bookmarktags, filter_text, message
 
@@ -580,35 +1026,48 @@ def get_bookmarks(userkey, filtermethod=None, sortmethod=None):
 @app.route('/<userkey>/<show_as>/filter/<filtermethod>', methods=['GET', 'POST'])
 @app.route('/<userkey>/<show_as>/sort/<sortmethod>', methods=['GET', 'POST'])
 def bookmarks_page(userkey, filtermethod=None, sortmethod=None, show_as='cards'):
-    bookmarks, bookmarktags, filter_text, message = get_bookmarks(userkey, filtermethod, sortmethod)
-    theme = get_theme(userkey)
-    return render_template(
-        'bookmarks.html',
-        bookmarks=bookmarks,
-        userkey=userkey,
-        tags=bookmarktags,
-        filter_text=filter_text,
-        message=message,
-        theme=theme,
-        editable=True,  # bookmarks can be edited
-        showtags=True,  # tags should be shown with the bookmarks
-        filtermethod=filtermethod,
-        sortmethod=sortmethod,
-        show_as=show_as,  # show list of bookmarks instead of cards
-    )
+    def render():
+        page = get_page()
+        bookmarks, bookmarktags, filter_text, message = get_bookmarks(userkey, filtermethod, sortmethod, page)
+        bookmarks, has_next_page = bookmarks_page_of(bookmarks)
+        theme = get_theme(userkey)
+        return render_template(
+            'bookmarks.html',
+            bookmarks=bookmarks,
+            page=page,
+            has_next_page=has_next_page,
+            userkey=userkey,
+            tags=bookmarktags,
+            filter_text=filter_text,
+            message=message,
+            theme=theme,
+            editable=True,  # bookmarks can be edited
+            showtags=True,  # tags should be shown with the bookmarks
+            filtermethod=filtermethod,
+            sortmethod=sortmethod,
+            show_as=show_as,  # show list of bookmarks instead of cards
+        )
+
+    if request.method == 'POST':
+        # Search form; its filter text is not in the url the page is cached on
+        return render()
+    return cached_page(userkey, render)
 
 
 @app.route('/<userkey>/js')
 def bookmarks_js(userkey):
     """ Return list of bookmarks with their favicons, to be used for autocompletion """
-    bookmarks = Bookmark.select().where(
-        Bookmark.userkey == userkey,
-        Bookmark.status == Bookmark.VISIBLE
-    ).order_by(Bookmark.created_date.desc())
-    resp = make_response(render_template(
-        'bookmarks.js',
-        bookmarks=bookmarks
-    ))
+    version = database_version()
+    javascript = bookmarks_js_cache.get(userkey, version)
+    if javascript is None:
+        # Plain dicts instead of Bookmark instances, the template only reads two fields of every bookmark
+        bookmarks = prepared_query(_visible_bookmark_titles, userkey).dicts().iterator()
+        javascript = render_template(
+            'bookmarks.js',
+            bookmarks=bookmarks
+        )
+        bookmarks_js_cache.put(userkey, version, javascript)
+    resp = make_response(javascript)
     resp.headers['Content-type'] = 'text/javascript; charset=utf-8'
     return resp
 
@@ -617,13 +1076,12 @@ def bookmarks_js(userkey):
 def bookmark_redirect(userkey, urlhash):
     """ Securely redirect a bookmark to its url, stripping referrer (if browser plays nice) """
     # @TODO: add counter to this bookmark
-    try:
-        bookmark = Bookmark.get(
-            Bookmark.url_hash == urlhash,
-            Bookmark.userkey == userkey,
-            Bookmark.status == Bookmark.VISIBLE
-        )
-    except Bookmark.DoesNotExist:
+    bookmark = Bookmark.get_or_none(
+        Bookmark.url_hash == urlhash,
+        Bookmark.userkey == userkey,
+        Bookmark.status == Bookmark.VISIBLE
+    )
+    if bookmark is None:
         abort(404)
     return render_template('redirect.html', url=bookmark.url)
 
@@ -634,7 +1092,7 @@ def bookmark_redirect(userkey, urlhash):
 def bookmarks_json(userkey, filtermethod=None, sortmethod=None):
     bookmarks, bookmarktags, filter_text, message = get_bookmarks(userkey, filtermethod, sortmethod)
 
-    bookmarkslist = [i.serialize for i in bookmarks]
+    bookmarkslist = list(serialize_query(bookmarks))
 
     the_data = {
         'bookmarks': bookmarkslist,
@@ -643,31 +1101,31 @@ def bookmarks_json(userkey, filtermethod=None, sortmethod=None):
         'message': message,
         'userkey': userkey,
     }
-    return jsonify(the_data)
+    return orjson_response(the_data)
 
 
 @app.route('/api/v1/<userkey>/<urlhash>')
 def bookmark_json(userkey, urlhash):
     """ Serialise bookmark to json """
-    try:
-        bookmark = Bookmark.get(
-            Bookmark.url_hash == urlhash,
-            Bookmark.userkey == userkey,
-            Bookmark.status == Bookmark.VISIBLE
-        )
-        return jsonify(bookmark.to_dict())
-    except Bookmark.DoesNotExist:
-        return jsonify({'message': 'Bookmark not found', 'status': 'error 404'})
+    # Only the serialised columns, as a dict; no Bookmark instance needed
+    query = Bookmark.select(
+        Bookmark.title, Bookmark.url, Bookmark.created_date, Bookmark.url_hash, Bookmark.tags
+    ).where(
+        Bookmark.url_hash == urlhash,
+        Bookmark.userkey == userkey,
+        Bookmark.status == Bookmark.VISIBLE
+    ).limit(1)
+    bookmark = next(serialize_query(query), None)
+    if bookmark is None:
+        return orjson_response({'message': 'Bookmark not found', 'status': 'error 404'})
+    return orjson_response(bookmark)
 
 
 @app.route('/api/v1/<userkey>/search/<filter_text>')
 def search_bookmark_titles_json(userkey, filter_text):
     """ Serialise bookmark to json """
     bookmarks = _find_bookmarks(userkey, filter_text)
-    result = []
-    for bookmark in bookmarks:
-        result.append(bookmark.to_dict())
-    return jsonify(result)
+    return orjson_response(list(serialize_query(bookmarks)))
 
 
 @app.route('/<userkey>/<urlhash>')
@@ -675,9 +1133,8 @@ def search_bookmark_titles_json(userkey, filter_text):
 def editbookmark(userkey, urlhash):
     """ Bookmark edit form """
     # bookmark = getbyurlhash()
-    try:
-        bookmark = Bookmark.get(Bookmark.url_hash == urlhash, Bookmark.userkey == userkey)
-    except Bookmark.DoesNotExist:
+    bookmark = Bookmark.get_or_none(Bookmark.url_hash == urlhash, Bookmark.userkey == userkey)
+    if bookmark is None:
         abort(404)
     message = request.args.get('message')
     tags = get_cached_tags(userkey)
@@ -721,7 +1178,11 @@ def addbookmark(userkey):
 
 
 def updatebookmark(userkey, urlhash=None):
-    """ Add (no urlhash) or edit (urlhash is set) a bookmark """
+    """ Add (no urlhash) or edit (urlhash is set) a bookmark
+
+    Returns a (bookmark, response) tuple: the saved bookmark, or the redirect response to show instead when the bookmark
+    already existed. Both are None when no url was supplied.
+    """
     title = request.form.get('title')
     url = request.form.get('url')
     tags = request.form.get('tags')
@@ -734,44 +1195,74 @@ def updatebookmark(userkey, urlhash=None):
         strip_params = True
 
     if url and not urlhash:
-        # New bookmark
-        bookmark, created = Bookmark.get_or_create(url=url, userkey=userkey)
-        if not created:
+        # New bookmark; only inserted at the end, together with its tags, instead of first inserting an empty one
+        bookmark = Bookmark.get_or_none(Bookmark.url == url, Bookmark.userkey == userkey)
+        if bookmark is not None:
             message = 'Existing bookmark, did not overwrite with new values'
-            return redirect(url_for('editbookmark', userkey=userkey, urlhash=bookmark.url_hash, message=message))
+            return bookmark, redirect(
+                url_for('editbookmark', userkey=userkey, urlhash=bookmark.url_hash, message=message)
+            )
+        bookmark = Bookmark(url=url, userkey=userkey)
     elif url:
         # Existing bookmark, get from DB
         bookmark = Bookmark.get(Bookmark.userkey == userkey, Bookmark.url_hash == urlhash)
         # Editing this bookmark, set modified_date to now
-        bookmark.modified_date = datetime.datetime.now()
+        bookmark.modified_date = DB_NOW
     else:
         # No url was supplied, abort. @TODO: raise exception?
-        return None
+        return None, None
 
     bookmark.title = title
     if strip_params:
         url = Bookmark.strip_url_params(url)
+    url_changed = url != bookmark.url
     bookmark.url = url
     bookmark.starred = starred
     bookmark.set_tags(tags)
     bookmark.note = note
-    bookmark.set_hash()
+    if url_changed or not bookmark.url_hash:
+        # Existing (md5) hashes are kept as long as the url stays the same, so links to the bookmark keep working
+        bookmark.set_hash()
     #bookmark.fetch_image()
+    is_new = bookmark.id is None
+    check_status_later = False
     if not title:
         # Title was empty, automatically fetch it from the url, will also update the status code
         bookmark.set_title_from_source()
-    else:
+    elif is_new or url_changed:
+        # The edit form shown next warns about a new url that is broken or redirected
         bookmark.set_status_code()
-
+    else:
+        # Only title, tags and such were edited; check whether the url still works after saving
+        check_status_later = True
+
+    # Bookmark and its tag rows are written in one transaction, so tag lookups never see a half updated bookmark
+    with database.atomic():
+        bookmark.save()
+        bookmark.save_tags(replace=not is_new)
+    if check_status_later:
+        background_tasks.submit(_check_status, bookmark.id, bookmark.url, bookmark.http_status)
     if bookmark.http_status == 200 or bookmark.http_status == 202:
-        try:
-            bookmark.set_favicon()
-        except IOError:
-            # Icon file could not be saved possibly, don't bail completely
-            pass
+        fetch_favicon_later(bookmark)
+    return bookmark, None
 
-    bookmark.save()
-    return bookmark
+
+def _check_status(bookmark_id, url, http_status):
+    """ Update the HTTP status of the bookmark with `bookmark_id` if it changed; runs in a background thread """
+    bookmark = Bookmark(id=bookmark_id, url=url, http_status=http_status)
+    try:
+        bookmark.set_status_code()
+    except requests.RequestException:
+        # Output of background threads is not shown anywhere else
+        app.logger.exception('Checking the status of %s failed', url)
+        return
+    if bookmark.http_status != http_status:
+        with database.connection_context():
+            # Only if the url was not changed in the meantime, which also sets its status
+            Bookmark.update(http_status=bookmark.http_status).where(
+                Bookmark.id == bookmark_id,
+                Bookmark.url == url
+            ).execute()
 
 
 @app.route('/<userkey>/adding', methods=['GET', 'POST'])
@@ -781,12 +1272,11 @@ def addingbookmark(userkey):
     tags = get_cached_tags(userkey)
 
     if request.method == 'POST':
-        bookmark = updatebookmark(userkey)
+        bookmark, response = updatebookmark(userkey)
+        if response:
+            return response
         if not bookmark:
             return redirect(url_for('addbookmark', userkey=userkey, message='No url provided', tags=tags))
-        if type(bookmark).__name__ == 'Response':
-            return bookmark
-        all_tags[userkey] = get_tags_for_user(userkey)
         return redirect(url_for('editbookmark', userkey=userkey, urlhash=bookmark.url_hash))
     return redirect(url_for('addbookmark', userkey=userkey, tags=tags))
 
@@ -796,8 +1286,7 @@ def editingbookmark(userkey, urlhash):
     """ Edit the bookmark from form submit """
 
     if request.method == 'POST':
-        bookmark = updatebookmark(userkey, urlhash=urlhash)
-        all_tags[userkey] = get_tags_for_user(userkey)
+        bookmark, _ = updatebookmark(userkey, urlhash=urlhash)
         return redirect(url_for('editbookmark', userkey=userkey, urlhash=bookmark.url_hash))
     return redirect(url_for('editbookmark', userkey=userkey, urlhash=urlhash))
 
@@ -805,9 +1294,7 @@ def editingbookmark(userkey, urlhash):
 @app.route('/<userkey>/<urlhash>/delete', methods=['GET', 'POST'])
 def deletingbookmark(userkey, urlhash):
     """ Delete the bookmark from form submit by <urlhash>/delete """
-    query = Bookmark.update(status=Bookmark.DELETED).where(Bookmark.userkey == userkey, Bookmark.url_hash == urlhash)
-    query.execute()
-    query = Bookmark.update(deleted_date=datetime.datetime.now()).where(
+    query = Bookmark.update(status=Bookmark.DELETED, deleted_date=DB_NOW).where(
         Bookmark.userkey == userkey,
         Bookmark.url_hash == urlhash
     )
@@ -817,7 +1304,6 @@ def deletingbookmark(userkey, urlhash):
         userkey=userkey,
         urlhash=urlhash
     ))
-    all_tags[userkey] = get_tags_for_user(userkey)
     return redirect(url_for('bookmarks_page', userkey=userkey, message=message))
 
 
@@ -827,46 +1313,53 @@ def undeletebookmark(userkey, urlhash):
     query = Bookmark.update(status=Bookmark.VISIBLE).where(Bookmark.userkey == userkey, Bookmark.url_hash == urlhash)
     query.execute()
     message = 'Bookmark restored'
-    all_tags[userkey] = get_tags_for_user(userkey)
     return redirect(url_for('bookmarks_page', userkey=userkey, message=message))
 
 
+def _count_where(condition):
+    """ Aggregate counting the rows matching `condition`, to combine several counts in one query """
+    return fn.COALESCE(fn.SUM(Case(None, [(condition, 1)], 0)), 0)
+
+
 @app.route('/<userkey>/tags')
 def tags_page(userkey):
     """ Overview of all tags used by user """
+    return cached_page(userkey, lambda: render_tags_page(userkey))
+
+
+def render_tags_page(userkey):
     tags = get_cached_tags(userkey)
-    #publictags = PublicTag.select().where(Bookmark.userkey == userkey)
+    # All public tags of this user in one query, only the columns needed for linking to them
+    publictags = PublicTag.select(PublicTag.tag, PublicTag.tagkey).where(PublicTag.userkey == userkey)
+    publictags = {publictag.tag: publictag for publictag in publictags}
+
+    # The tag cache keeps count of the bookmarks per tag
+    tagcounts = get_tag_counts(userkey)
+
     alltags = []
     for tag in tags:
-        try:
-            publictag = PublicTag.get(PublicTag.userkey == userkey, PublicTag.tag == tag)
-        except PublicTag.DoesNotExist:
-            publictag = None
-
-        total = Bookmark.select().where(
-            Bookmark.userkey == userkey,
-            Bookmark.tags.contains(tag),
-            Bookmark.status == Bookmark.VISIBLE
-        ).count()
-        alltags.append({'tag': tag, 'publictag': publictag, 'total': total})
-    totaltags = len(alltags)
-    totalbookmarks = Bookmark.select().where(Bookmark.userkey == userkey, Bookmark.status == Bookmark.VISIBLE).count()
-    totalpublic = PublicTag.select().where(PublicTag.userkey == userkey).count()
-    totalstarred = Bookmark.select().where(Bookmark.userkey == userkey, Bookmark.starred).count()
-    totaldeleted = Bookmark.select().where(Bookmark.userkey == userkey, Bookmark.status == Bookmark.DELETED).count()
-    totalnotes = Bookmark.select().where(Bookmark.userkey == userkey, Bookmark.note != '').count()
-    totalhttperrorstatus = Bookmark.select().where(Bookmark.userkey == userkey, Bookmark.http_status != 200).count()
+        alltags.append({'tag': tag, 'publictag': publictags.get(tag), 'total': tagcounts[tag]})
+
+    # All statistics in one query instead of a count() per statistic
+    totals = Bookmark.select(
+        _count_where(Bookmark.status == Bookmark.VISIBLE).alias('totalbookmarks'),
+        _count_where(Bookmark.status == Bookmark.DELETED).alias('totaldeleted'),
+        _count_where(Bookmark.starred).alias('totalstarred'),
+        _count_where(Bookmark.note != '').alias('totalnotes'),
+        _count_where(Bookmark.http_status != 200).alias('totalhttperrorstatus'),
+    ).where(Bookmark.userkey == userkey).dicts().get()
+
     theme = get_theme(userkey)
     return render_template(
         'tags.html',
         tags=alltags,
-        totaltags=totaltags,
-        totalpublic=totalpublic,
-        totalbookmarks=totalbookmarks,
-        totaldeleted=totaldeleted,
-        totalstarred=totalstarred,
-        totalhttperrorstatus=totalhttperrorstatus,
-        totalnotes=totalnotes,
+        totaltags=len(alltags),
+        totalpublic=len(publictags),
+        totalbookmarks=totals['totalbookmarks'],
+        totaldeleted=totals['totaldeleted'],
+        totalstarred=totals['totalstarred'],
+        totalhttperrorstatus=totals['totalhttperrorstatus'],
+        totalnotes=totals['totalnotes'],
         userkey=userkey,
         theme=theme
     )
@@ -875,24 +1368,24 @@ def tags_page(userkey):
 @app.route('/<userkey>/tag/<tag>')
 def tag_page(userkey, tag):
     """ Overview of all bookmarks with a certain tag """
-    bookmarks = Bookmark.select().where(
-        Bookmark.userkey == userkey,
-        Bookmark.tags.contains(tag),
-        Bookmark.status == Bookmark.VISIBLE
-    ).order_by(Bookmark.created_date.desc())
+    return cached_page(userkey, lambda: render_tag_page(userkey, tag))
+
+
+def render_tag_page(userkey, tag):
+    page = get_page()
+    bookmarks, has_next_page = bookmarks_page_of(_find_bookmarks_with_tag(userkey, tag, page))
     tags = get_cached_tags(userkey)
     pageheader = 'tag: ' + tag
     message = request.args.get('message')
 
-    try:
-        publictag = PublicTag.get(PublicTag.userkey == userkey, PublicTag.tag == tag)
-    except PublicTag.DoesNotExist:
-        publictag = None
+    publictag = PublicTag.get_or_none(PublicTag.userkey == userkey, PublicTag.tag == tag)
 
     theme = get_theme(userkey)
     return render_template(
         'bookmarks.html',
         bookmarks=bookmarks,
+        page=page,
+        has_next_page=has_next_page,
         userkey=userkey,
         tags=tags,
         tag=tag,
@@ -905,14 +1398,15 @@ def tag_page(userkey, tag):
     )
 
 
-def get_publictag(tagkey):
-    """ Return tag and bookmarks in this public tag collection """
-    this_tag = PublicTag.get(PublicTag.tagkey == tagkey)
-    bookmarks = Bookmark.select().where(
-        Bookmark.userkey == this_tag.userkey,
-        Bookmark.tags.contains(this_tag.tag),
-        Bookmark.status == Bookmark.VISIBLE
-    ).order_by(Bookmark.created_date.desc())
+def get_publictag(tagkey, build=_bookmarks_with_tag, page=None):
+    """ Return tag and bookmarks in this public tag collection, or abort with a 404 if it does not exist
+
+    The bookmarks are selected with the query builder `build`, which can limit the columns that are needed.
+    """
+    this_tag = PublicTag.get_or_none(PublicTag.tagkey == tagkey)
+    if this_tag is None:
+        abort(404)
+    bookmarks = prepared_query(build, this_tag.userkey, this_tag.tag, page=page)
     return this_tag, bookmarks
 
 
@@ -920,92 +1414,91 @@ def get_publictag(tagkey):
 def publictag_page(tagkey):
     """ Read-only overview of the bookmarks in the userkey/tag of this PublicTag """
     #this_tag = get_object_or_404(PublicTag.select().where(PublicTag.tagkey == tagkey))
-    try:
-        this_tag, bookmarks = get_publictag(tagkey)
-        theme = themes[DEFAULT_THEME]
-        return render_template(
-            'publicbookmarks.html',
-            bookmarks=bookmarks,
-            tag=this_tag.tag,
-            action=this_tag.tag,
-            tagkey=tagkey,
-            theme=theme
-        )
-    except PublicTag.DoesNotExist:
-        abort(404)
+    page = get_page()
+    this_tag, bookmarks = get_publictag(tagkey, page=page)
+    bookmarks, has_next_page = bookmarks_page_of(bookmarks)
+    return render_template(
+        'publicbookmarks.html',
+        bookmarks=bookmarks,
+        page=page,
+        has_next_page=has_next_page,
+        tag=this_tag.tag,
+        action=this_tag.tag,
+        tagkey=tagkey,
+        theme=default_theme
+    )
 
 
 @app.route('/api/v1/pub/<tagkey>')
 def publictag_json(tagkey):
     """ json representation of the Read-only overview of the bookmarks in the userkey/tag of this PublicTag """
-    try:
-        this_tag, bookmarks = get_publictag(tagkey)
-        result = {
-            #'tag': this_tag,
-            'tagkey': tagkey,
-            'count': len(bookmarks),
-            'items': [],
-        }
-        for bookmark in bookmarks:
-            result['items'].append(bookmark.to_dict())
-        return jsonify(result)
-    except PublicTag.DoesNotExist:
-        abort(404)
+    this_tag, bookmarks = get_publictag(tagkey, _public_bookmarks_with_tag)
+    items = list(serialize_query(bookmarks))
+    result = {
+        #'tag': this_tag,
+        'tagkey': tagkey,
+        'count': len(items),
+        'items': items,
+    }
+    return orjson_response(result)
+
+
+ATOM_ENTRY = """  <entry>
+    <id>{id}</id>
+    <title>{title}</title>
+    <updated>{updated}</updated>
+    <author>
+      <name>digimarks</name>
+    </author>
+    <link href={link}/>
+    <published>{published}</published>
+  </entry>
+"""
+
+
+def atom_date(date):
+    """ RFC 3339 timestamp in local time, as used in Atom feeds """
+    return date.replace(tzinfo=tz.tzlocal()).isoformat()
 
 
 @app.route('/pub/<tagkey>/feed')
 def publictag_feed(tagkey):
     """ rss/atom representation of the Read-only overview of the bookmarks in the userkey/tag of this PublicTag """
-    try:
-        this_tag = PublicTag.get(PublicTag.tagkey == tagkey)
-        bookmarks = Bookmark.select().where(
-            Bookmark.userkey == this_tag.userkey,
-            Bookmark.tags.contains(this_tag.tag),
-            Bookmark.status == Bookmark.VISIBLE
-        )
+    this_tag, bookmarks = get_publictag(tagkey, _public_bookmarks_with_tag)
+    feed_url = request.url
+    page_url = url_for('publictag_page', tagkey=tagkey, _external=True)
+
+    def generate():
+        """ Stream the feed entry by entry, so big public tags are never completely held in memory """
+        yield '<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+        yield '  <id>{}</id>\n  <title>{}</title>\n  <updated>{}</updated>\n'.format(
+            xml_escape(feed_url), xml_escape(this_tag.tag), atom_date(datetime.datetime.now()))
+        yield '  <link href={} rel="self"/>\n  <link href={}/>\n'.format(quoteattr(feed_url), quoteattr(page_url))
+        for bookmark in bookmarks.dicts().iterator():
+            updated_date = bookmark['modified_date']
+            if not bookmark['modified_date']:
+                updated_date = bookmark['created_date']
+            bookmarktitle = '{} (no title)'.format(bookmark['url'])
+            if bookmark['title']:
+                bookmarktitle = bookmark['title']
+            yield ATOM_ENTRY.format(
+                id=xml_escape(bookmark['url']),
+                title=xml_escape(bookmarktitle),
+                updated=atom_date(updated_date),
+                link=quoteattr(bookmark['url']),
+                published=atom_date(bookmark['created_date']),
+            )
+        yield '</feed>\n'
 
-        feed = FeedGenerator()
-        feed.title(this_tag.tag)
-        feed.id(request.url)
-        feed.link(href=request.url, rel='self')
-        feed.link(href=make_external(url_for('publictag_page', tagkey=tagkey)))
-
-        for bookmark in bookmarks:
-            entry = feed.add_entry()
-
-            updated_date = bookmark.modified_date
-            if not bookmark.modified_date:
-                updated_date = bookmark.created_date
-            bookmarktitle = '{} (no title)'.format(bookmark.url)
-            if bookmark.title:
-                bookmarktitle = bookmark.title
-
-            entry.id(bookmark.url)
-            entry.title(bookmarktitle)
-            entry.link(href=bookmark.url)
-            entry.author(name='digimarks')
-            entry.pubdate(bookmark.created_date.replace(tzinfo=tz.tzlocal()))
-            entry.published(bookmark.created_date.replace(tzinfo=tz.tzlocal()))
-            entry.updated(updated_date.replace(tzinfo=tz.tzlocal()))
-
-        response = make_response(feed.atom_str(pretty=True))
-        response.headers.set('Content-Type', 'application/atom+xml')
-        return response
-    except PublicTag.DoesNotExist:
-        abort(404)
+    return Response(stream_with_context(generate()), mimetype='application/atom+xml')
 
 
 @app.route('/<userkey>/<tag>/makepublic', methods=['GET', 'POST'])
 def addpublictag(userkey, tag):
     #user = get_object_or_404(User.get(User.key == userkey))
-    try:
-        User.get(User.key == userkey)
-    except User.DoesNotExist:
+    if User.get_or_none(User.key == userkey) is None:
         abort(404)
-    try:
-        publictag = PublicTag.get(PublicTag.userkey == userkey, PublicTag.tag == tag)
-    except PublicTag.DoesNotExist:
-        publictag = None
+    publictag = PublicTag.get_or_none(PublicTag.userkey == userkey, PublicTag.tag == tag)
     if not publictag:
         newpublictag = PublicTag()
         newpublictag.generate_key()
@@ -1036,25 +1529,89 @@ def adduser(systemkey):
         newuser.generate_key()
         newuser.username = 'Nomen Nescio'
         newuser.save()
-        all_tags[newuser.key] = []
-        return redirect('/{}'.format(newuser.key.decode("utf-8")), code=302)
+        return redirect('/{}'.format(newuser.key), code=302)
     else:
         abort(404)
 
 
+def fetch_favicons(bookmarks):
+    """ Fetch the favicons of `bookmarks` concurrently, once per domain; yields the bookmarks as they are done """
+    by_domain = collections.defaultdict(list)
+    for bookmark in bookmarks:
+        by_domain[parse_url(bookmark.url).netloc].append(bookmark)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=FAVICON_WORKERS) as executor:
+        futures = {executor.submit(domain_bookmarks[0].set_favicon): domain_bookmarks
+                   for domain_bookmarks in by_domain.values()}
+        for future in concurrent.futures.as_completed(futures):
+            domain_bookmarks = futures[future]
+            try:
+                future.result()
+            except (IOError, requests.RequestException) as e:
+                print(e)
+            for bookmark in domain_bookmarks:
+                bookmark.favicon = domain_bookmarks[0].favicon
+                yield bookmark
+
+
+def save_favicons(bookmarks):
+    """ Store the new favicons of `bookmarks`, committing them in batches instead of one transaction per bookmark """
+    for batch in chunked(bookmarks, 100):
+        with database.atomic():
+            for bookmark in batch:
+                bookmark.save(only=[Bookmark.favicon])
+
+
+def _fetch_favicon(bookmark_id, userkey, url):
+    """ Fetch the favicon for the bookmark with `bookmark_id` and store it; runs in a background thread """
+    bookmark = Bookmark(id=bookmark_id, userkey=userkey, url=url)
+    try:
+        bookmark.set_favicon()
+    except (IOError, requests.RequestException):
+        # Icon could not be fetched or saved, the fallback icon will be shown
+        app.logger.exception('Fetching the favicon of %s failed', url)
+        return
+    if bookmark.favicon:
+        pending_favicons.put((bookmark_id, bookmark.favicon))
+        favicon_writer.submit(_write_favicons)
+
+
+def _write_favicons():
+    """ Store all favicons waiting in `pending_favicons` in one transaction; runs in the favicon writer thread """
+    updates = []
+    while True:
+        try:
+            updates.append(pending_favicons.get_nowait())
+        except queue.Empty:
+            break
+    if not updates:
+        # Already stored together with those of an earlier bookmark
+        return
+    try:
+        with database.connection_context(), database.atomic():
+            for bookmark_id, favicon in updates:
+                Bookmark.update(favicon=favicon).where(Bookmark.id == bookmark_id).execute()
+    except DatabaseError:
+        app.logger.exception('Storing %d favicons failed', len(updates))
+
+
+def fetch_favicon_later(bookmark):
+    """ Fetch the favicon of `bookmark` in the background, so saving it does not wait for the favicon service """
+    background_tasks.submit(_fetch_favicon, bookmark.id, bookmark.userkey, bookmark.url)
+
+
 @app.route('/<systemkey>/refreshfavicons')
 def refreshfavicons(systemkey):
     """ Add user endpoint, convenience """
     if systemkey == settings.SYSTEMKEY:
-        bookmarks = Bookmark.select()
-        for bookmark in bookmarks:
-            if bookmark.favicon:
-                try:
-                    filename = os.path.join(MEDIA_ROOT, 'favicons/' + bookmark.favicon)
-                    os.remove(filename)
-                except OSError as e:
-                    print(e)
-            bookmark.set_favicon()
+        bookmarks = list(Bookmark.select())
+        # Favicons are stored per domain, so remove each file once instead of once for every bookmark using it
+        for favicon in {bookmark.favicon for bookmark in bookmarks if bookmark.favicon}:
+            try:
+                os.remove(os.path.join(MEDIA_ROOT, 'favicons/' + favicon))
+            except OSError as e:
+                print(e)
+        # Database writes stay in this thread, only the downloads are done concurrently
+        save_favicons(fetch_favicons(bookmarks))
         return redirect('/')
     else:
         abort(404)
@@ -1064,37 +1621,59 @@ def refreshfavicons(systemkey):
 def findmissingfavicons(systemkey):
     """ Add user endpoint, convenience """
     if systemkey == settings.SYSTEMKEY:
-        bookmarks = Bookmark.select()
-        for bookmark in bookmarks:
-            try:
-                if not bookmark.favicon or not os.path.isfile(os.path.join(MEDIA_ROOT, 'favicons/' + bookmark.favicon)):
-                    # This favicon is missing
-                    # Clear favicon, so fallback can be used instead of showing a broken image
-                    bookmark.favicon = None
-                    bookmark.save()
-                    # Try to fetch and save new favicon
-                    bookmark.set_favicon()
-                    bookmark.save()
-            except OSError as e:
-                print(e)
+        missing = []
+        for bookmark in Bookmark.select():
+            if not bookmark.favicon or not os.path.isfile(os.path.join(MEDIA_ROOT, 'favicons/' + bookmark.favicon)):
+                # This favicon is missing
+                # Clear favicon, so fallback can be used instead of showing a broken image
+                bookmark.favicon = None
+                missing.append(bookmark)
+        save_favicons(missing)
+        # Try to fetch and save new favicons
+        save_favicons(fetch_favicons(missing))
         return redirect('/')
     else:
         abort(404)
 
 
-# Initialisation == create the bookmark, user and public tag tables if they do not exist
-Bookmark.create_table(True)
-User.create_table(True)
-PublicTag.create_table(True)
+def init_db():
+    """ Create the tables (and search index) if they do not exist yet, and load the user themes
+
+    Runs in an exclusive transaction, so when several workers start at the same time only the first one creates and
+    fills new tables, and the others find them ready.
+    """
+    with database.atomic('EXCLUSIVE'):
+        # Create the bookmark, user and public tag tables if they do not exist
+        Bookmark.create_table(True)
+        User.create_table(True)
+        PublicTag.create_table(True)
+        if BookmarkIndex.table_exists() and 'tags' in [column.name for column in database.get_columns('bookmarkindex')]:
+            # Search index of an earlier version, which also indexed the tags on every update; create it anew
+            for trigger in ('bookmark_ai', 'bookmark_ad', 'bookmark_au'):
+                database.execute_sql('DROP TRIGGER IF EXISTS ' + trigger)
+            BookmarkIndex.drop_table()
+        if not BookmarkIndex.table_exists():
+            # New search index, fill it with the existing bookmarks
+            BookmarkIndex.create_table()
+            BookmarkIndex.rebuild()
+        for trigger in BOOKMARKINDEX_TRIGGERS:
+            database.execute_sql(trigger)
+        if not BookmarkTag.table_exists():
+            # New tag table, fill it with the tags of the existing bookmarks
+            BookmarkTag.create_table()
+            database.execute_sql(FILL_BOOKMARKTAGS)
+
+    users = User.select()
+    print('Current user keys:')
+    for user in users:
+        userthemes[user.key] = themes.get(user.theme, default_theme)
+        print(user.key)
 
-users = User.select()
-print('Current user keys:')
-for user in users:
-    all_tags[user.key] = get_tags_for_user(user.key)
-    usersettings[user.key] = {'theme': user.theme}
-    print(user.key)
 
 # Run when called standalone
 if __name__ == '__main__':
+    init_db()
+    db_initialised = True
+    database.close()
     # run the application
-    app.run(host='0.0.0.0', port=9999, debug=True)
+    app.run(host='0.0.0.0', port=9999, debug=getattr(settings, 'DEBUG', False))
@@ -5,6 +5,10 @@ PORT = 8086
 
 DEBUG = False
 
+# Directory for the compiled templates, needs to be writable by the user running digimarks (optional, defaults to
+# .jinja_cache next to digimarks.py; compiled templates are not kept on disk if it is not writable)
+#JINJA_CACHE_DIR = '/var/cache/digimarks/jinja'
+
 # Password/url key to do admin stuff with, like adding a user
 # NB: change this to something else! For example, in bash:
 # echo -n "yourstring" | sha1sum